@@ -1,9 +1,14 @@
 import streamlit as st
+import numpy as np
 import spacy
+from spacy.attrs import IS_PUNCT, IS_SPACE, LEMMA, LOWER, POS
+from spacy.symbols import ADJ, ADV, NOUN, VERB
 import pandas as pd
 from datetime import datetime
 import subprocess
 import sys
+import threading
+from collections import OrderedDict
 
 # Page config
 st.set_page_config(page_title="Text Overlap Analyzer", layout="wide")
@@ -18,32 +23,110 @@ LANGUAGE_MODELS = {
     "Portuguese": "pt_core_news_sm"
 }
 
+# Components no metric relies on; the parser stays since it sets sentence boundaries.
+# Excluded rather than disabled so their weights are never read from disk.
+EXCLUDED_COMPONENTS = ["ner"]
+
+# Universal POS tags counted as content words, as spaCy's integer symbols
+CONTENT_POS = frozenset((NOUN, VERB, ADJ, ADV))
+# Same tags as a uint64 array, matching the dtype of Doc.to_array for np.isin
+CONTENT_POS_ARRAY = np.array(sorted(CONTENT_POS), dtype=np.uint64)
+
+# Result keys, in display order
+METRIC_KEYS = ['total_overlap', 'lemma_overlap', 'content_overlap', 'lemma_content_overlap', 'multiword_overlap']
+
+# Column order of the CSV export
+CSV_COLUMNS = ['Timestamp', 'Language', 'Reference Text', 'Target Text', 'Metric', 'Score', 'Category', 'Items']
+
+# Per-text feature sets kept per model for repeat analyses
+FEATURE_CACHE_SIZE = 128
+
 @st.cache_resource
 def load_model(model_name):
     """Load spaCy model, download if necessary"""
     try:
-        return spacy.load(model_name)
+        return spacy.load(model_name, exclude=EXCLUDED_COMPONENTS)
     except OSError:
         st.info(f"⏳ Downloading {model_name} language model (first time only, ~30 seconds)...")
         subprocess.check_call([sys.executable, "-m", "spacy", "download", model_name])
-        return spacy.load(model_name)
+        return spacy.load(model_name, exclude=EXCLUDED_COMPONENTS)
+
+@st.cache_resource
+def get_feature_cache(model_name, model_id):
+    """LRU store of per-text feature sets for one loaded model, shared across reruns and sessions"""
+    return OrderedDict(), threading.Lock()
+
+def get_text_features(nlp, model_name, texts):
+    """Return feature sets for each text, parsing cache misses in a single nlp.pipe batch"""
+    # Cached sets hold string IDs that only decode against this instance's StringStore,
+    # so a reloaded model (new vocab) must get a fresh store
+    cache, lock = get_feature_cache(model_name, id(nlp))
+    with lock:
+        features = {text: cache[text] for text in texts if text in cache}
+    
+    # Parse outside the lock so one session's long text never blocks the others;
+    # two sessions racing on the same text just parse it twice
+    missing = [text for text in dict.fromkeys(texts) if text not in features]
+    for text, doc in zip(missing, nlp.pipe(missing)):
+        features[text] = (*get_token_sets(doc), get_multiword_units(doc))
+    
+    with lock:
+        for text, entry in features.items():
+            cache[text] = entry
+            cache.move_to_end(text)
+        
+        while len(cache) > FEATURE_CACHE_SIZE:
+            cache.popitem(last=False)
+    
+    return [features[text] for text in texts]
+
+def get_token_sets(doc):
+    """Collect token, lemma, content word and content lemma sets from the Doc's attribute array"""
+    # Sets hold spaCy's integer string IDs of the lowercased forms; decode via vocab.strings
+    strings = doc.vocab.strings
+    attrs = doc.to_array([LOWER, LEMMA, POS, IS_PUNCT])
+    lowers = attrs[:, 0]
+    
+    # Lemmas keep their case (e.g. proper nouns), so lowercase each distinct lemma once
+    lemma_ids, lemma_index = np.unique(attrs[:, 1], return_inverse=True)
+    lower_lemma_ids = np.array([strings.add(strings[int(i)].lower()) for i in lemma_ids.tolist()], dtype=np.uint64)
+    lemmas = lower_lemma_ids[lemma_index.reshape(-1)]
+    
+    not_punct = attrs[:, 3] == 0
+    is_content = np.isin(attrs[:, 2], CONTENT_POS_ARRAY)
+    
+    return (
+        frozenset(lowers[not_punct].tolist()),
+        frozenset(lemmas[not_punct].tolist()),
+        frozenset(lowers[is_content].tolist()),
+        frozenset(lemmas[is_content].tolist())
+    )
+
+def overlap_score(ref_items, target_items, overlap):
+    """Jaccard score computed from set sizes, without building the union set"""
+    union_size = len(ref_items) + len(target_items) - len(overlap)
+    return len(overlap) / union_size if union_size else 0
+
+def decode_sorted(ids, strings):
+    """Map integer string IDs back to text, sorted alphabetically for display"""
+    return sorted(strings[i] for i in ids)
 
 def get_multiword_units(doc, max_n=6):
     """Extract n-grams of various lengths, respecting sentence boundaries"""
-    ngrams = set()
-    
-    for sent in doc.sents:
-        # Get tokens from this sentence (excluding punctuation and spaces)
-        tokens = [token.text.lower() for token in sent if not token.is_punct and not token.is_space]
-        
-        # Extract n-grams from length 2 up to max_n (or length of sentence)
-        max_length = min(len(tokens), max_n)
-        for n in range(2, max_length + 1):
-            for i in range(len(tokens) - n + 1):
-                ngram = ' '.join(tokens[i:i+n])
-                ngrams.add(ngram)
-    
-    return ngrams
+    # N-grams are tuples of lowercase string IDs; only shared ones get decoded for display
+    attrs = doc.to_array([LOWER, IS_PUNCT, IS_SPACE])
+    keep = (attrs[:, 1] == 0) & (attrs[:, 2] == 0)
+    
+    # Get tokens from each sentence (excluding punctuation and spaces)
+    sentences = (attrs[sent.start:sent.end, 0][keep[sent.start:sent.end]].tolist() for sent in doc.sents)
+    
+    # Extract n-grams from length 2 up to max_n (or length of sentence), built frozen in one pass
+    return frozenset(
+        tuple(tokens[i:i+n])
+        for tokens in sentences
+        for n in range(2, min(len(tokens), max_n) + 1)
+        for i in range(len(tokens) - n + 1)
+    )
 
 def filter_longest_ngrams(ngrams):
     """Keep only the longest n-grams, removing those that are subsumed by longer ones"""
@@ -78,90 +161,89 @@ def filter_longest_ngrams(ngrams):
     
     return sorted(longest_only)
 
+def compare_sets(ref_items, target_items, strings):
+    """Score one set-based metric and list its overlapping and one-sided items"""
+    if ref_items is target_items:
+        # Same text on both sides: everything overlaps and nothing is one-sided
+        overlap, ref_only, target_only = ref_items, (), ()
+    else:
+        # Plain set & set: CPython already iterates the smaller operand and probes the larger
+        overlap = ref_items & target_items
+        ref_only, target_only = ref_items - target_items, target_items - ref_items
+    
+    return {
+        'score': overlap_score(ref_items, target_items, overlap),
+        'overlapping': decode_sorted(overlap, strings),
+        'ref_only': decode_sorted(ref_only, strings),
+        'target_only': decode_sorted(target_only, strings)
+    }
+
+def add_joined_items(results):
+    """Add comma-joined '<list>_str' entries, built once and reused by the result tabs and CSV"""
+    for result in results.values():
+        for field in ('overlapping', 'ref_only', 'target_only'):
+            result[f'{field}_str'] = ', '.join(result[field])
+    return results
+
+def empty_results():
+    """Zeroed results for inputs with nothing to compare"""
+    results = {key: {'score': 0, 'overlapping': [], 'ref_only': [], 'target_only': []} for key in METRIC_KEYS}
+    return add_joined_items(results)
+
 def calculate_overlaps_detailed(reference_text, target_text, nlp):
     """Calculate overlaps and return detailed information."""
-    ref_doc = nlp(reference_text)
-    target_doc = nlp(target_text)
+    # Every score is 0 when either side is blank, so skip the pipeline entirely
+    if not reference_text.strip() or not target_text.strip():
+        return empty_results()
+    
+    # Cache key includes the model so switching language never reuses stale features
+    model_name = f"{nlp.lang}_{nlp.meta['name']}"
+    # Identical texts are parsed once and share one feature tuple, which the comparisons short-circuit on
+    ref_features, target_features = get_text_features(nlp, model_name, [reference_text, target_text])
+    ref_tokens, ref_lemmas, ref_content, ref_content_lemmas, ref_ngrams = ref_features
+    target_tokens, target_lemmas, target_content, target_content_lemmas, target_ngrams = target_features
+    strings = nlp.vocab.strings
     
     results = {}
     
     # 1. Total token overlap
-    ref_tokens = set([token.text.lower() for token in ref_doc if not token.is_punct])
-    target_tokens = set([token.text.lower() for token in target_doc if not token.is_punct])
-    overlap_tokens = ref_tokens & target_tokens
-    results['total_overlap'] = {
-        'score': len(overlap_tokens) / len(ref_tokens | target_tokens) if (ref_tokens | target_tokens) else 0,
-        'overlapping': sorted(list(overlap_tokens)),
-        'ref_only': sorted(list(ref_tokens - target_tokens)),
-        'target_only': sorted(list(target_tokens - ref_tokens))
-    }
+    results['total_overlap'] = compare_sets(ref_tokens, target_tokens, strings)
     
     # 2. Lemmatized overlap
-    ref_lemmas = set([token.lemma_.lower() for token in ref_doc if not token.is_punct])
-    target_lemmas = set([token.lemma_.lower() for token in target_doc if not token.is_punct])
-    overlap_lemmas = ref_lemmas & target_lemmas
-    results['lemma_overlap'] = {
-        'score': len(overlap_lemmas) / len(ref_lemmas | target_lemmas) if (ref_lemmas | target_lemmas) else 0,
-        'overlapping': sorted(list(overlap_lemmas)),
-        'ref_only': sorted(list(ref_lemmas - target_lemmas)),
-        'target_only': sorted(list(target_lemmas - ref_lemmas))
-    }
+    results['lemma_overlap'] = compare_sets(ref_lemmas, target_lemmas, strings)
     
     # 3. Content word overlap
-    content_pos = {"NOUN", "VERB", "ADJ", "ADV"}
-    ref_content = set([token.text.lower() for token in ref_doc if token.pos_ in content_pos])
-    target_content = set([token.text.lower() for token in target_doc if token.pos_ in content_pos])
-    overlap_content = ref_content & target_content
-    results['content_overlap'] = {
-        'score': len(overlap_content) / len(ref_content | target_content) if (ref_content | target_content) else 0,
-        'overlapping': sorted(list(overlap_content)),
-        'ref_only': sorted(list(ref_content - target_content)),
-        'target_only': sorted(list(target_content - ref_content))
-    }
+    results['content_overlap'] = compare_sets(ref_content, target_content, strings)
     
     # 4. Lemmatized content word overlap
-    ref_content_lemmas = set([token.lemma_.lower() for token in ref_doc if token.pos_ in content_pos])
-    target_content_lemmas = set([token.lemma_.lower() for token in target_doc if token.pos_ in content_pos])
-    overlap_content_lemmas = ref_content_lemmas & target_content_lemmas
-    results['lemma_content_overlap'] = {
-        'score': len(overlap_content_lemmas) / len(ref_content_lemmas | target_content_lemmas) if (ref_content_lemmas | target_content_lemmas) else 0,
-        'overlapping': sorted(list(overlap_content_lemmas)),
-        'ref_only': sorted(list(ref_content_lemmas - target_content_lemmas)),
-        'target_only': sorted(list(target_content_lemmas - ref_content_lemmas))
-    }
+    results['lemma_content_overlap'] = compare_sets(ref_content_lemmas, target_content_lemmas, strings)
     
     # 5. Multiword unit overlap (longest forms only, respecting sentence boundaries)
-    ref_ngrams = get_multiword_units(ref_doc)
-    target_ngrams = get_multiword_units(target_doc)
-    overlap_ngrams = ref_ngrams & target_ngrams
+    overlap_ngrams = ref_ngrams if ref_ngrams is target_ngrams else ref_ngrams & target_ngrams
     
     # Filter to keep only longest overlapping n-grams
-    longest_overlap = filter_longest_ngrams(overlap_ngrams)
+    overlap_phrases = {' '.join([strings[i] for i in ngram]) for ngram in overlap_ngrams}
+    longest_overlap = filter_longest_ngrams(overlap_phrases)
     
     results['multiword_overlap'] = {
-        'score': len(overlap_ngrams) / len(ref_ngrams | target_ngrams) if (ref_ngrams | target_ngrams) else 0,
+        'score': overlap_score(ref_ngrams, target_ngrams, overlap_ngrams),
         'overlapping': longest_overlap,
         'ref_only': [],  # Not shown for multiword units
         'target_only': []  # Not shown for multiword units
     }
     
-    return results
+    return add_joined_items(results)
 
-def create_csv_data(reference_text, target_text, results, language):
+def create_csv_data(reference_text, target_text, results, language, analyzed_at):
     """Create CSV-ready data from results."""
-    rows = []
-    
     # Summary row
-    rows.append({
-        'Timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-        'Language': language,
-        'Reference Text': reference_text[:100] + "..." if len(reference_text) > 100 else reference_text,
-        'Target Text': target_text[:100] + "..." if len(target_text) > 100 else target_text,
-        'Metric': 'Summary',
-        'Score': '',
-        'Category': '',
-        'Items': ''
-    })
+    rows = [(
+        analyzed_at.strftime("%Y-%m-%d %H:%M:%S"),
+        language,
+        reference_text[:100] + "..." if len(reference_text) > 100 else reference_text,
+        target_text[:100] + "..." if len(target_text) > 100 else target_text,
+        'Summary', '', '', ''
+    )]
     
     # Detail rows
     metric_names = {
@@ -174,41 +256,17 @@ def create_csv_data(reference_text, target_text, results, language):
     
     for key, name in metric_names.items():
         result = results[key]
-        rows.append({
-            'Timestamp': '',
-            'Language': '',
-            'Reference Text': '',
-            'Target Text': '',
-            'Metric': name,
-            'Score': f"{result['score']:.3f}",
-            'Category': 'Overlapping',
-            'Items': ', '.join(result['overlapping']) if result['overlapping'] else 'None'
-        })
+        rows.append(('', '', '', '', name, f"{result['score']:.3f}", 'Overlapping',
+                     result['overlapping_str'] or 'None'))
         
         # Only show ref_only and target_only for non-multiword metrics
         if key != 'multiword_overlap':
-            rows.append({
-                'Timestamp': '',
-                'Language': '',
-                'Reference Text': '',
-                'Target Text': '',
-                'Metric': name,
-                'Score': '',
-                'Category': 'Reference Only',
-                'Items': ', '.join(result['ref_only']) if result['ref_only'] else 'None'
-            })
-            rows.append({
-                'Timestamp': '',
-                'Language': '',
-                'Reference Text': '',
-                'Target Text': '',
-                'Metric': name,
-                'Score': '',
-                'Category': 'Target Only',
-                'Items': ', '.join(result['target_only']) if result['target_only'] else 'None'
-            })
-    
-    return pd.DataFrame(rows)
+            rows.append(('', '', '', '', name, '', 'Reference Only',
+                         result['ref_only_str'] or 'None'))
+            rows.append(('', '', '', '', name, '', 'Target Only',
+                         result['target_only_str'] or 'None'))
+    
+    return pd.DataFrame(rows, columns=CSV_COLUMNS)
 
 # UI
 st.title("📊 Text Overlap Analyzer")
@@ -322,14 +380,18 @@ with col2:
         key='target_input'
     )
 
+# st.button is only True on the rerun its click triggers, so other reruns (loading an
+# example, switching tabs) redisplay the stored results without re-running the analysis
 if st.button("🔍 Analyze Overlap", type="primary"):
-    if reference and target:
+    if reference.strip() and target.strip():
         with st.spinner(f"Analyzing texts in {selected_language}..."):
             results = calculate_overlaps_detailed(reference, target, nlp)
             st.session_state.results = results
-            st.session_state.reference = reference
-            st.session_state.target = target
-            st.session_state.language = selected_language
+            
+            # Build and encode the export once here; reruns that redisplay results reuse it
+            csv_data = create_csv_data(reference, target, results, selected_language, datetime.now())
+            st.session_state.csv_data = csv_data
+            st.session_state.csv_bytes = csv_data.to_csv(index=False).encode()
     else:
         st.warning("Please enter both reference and target texts.")
 
@@ -359,9 +421,7 @@ if 'results' in st.session_state:
     # Detailed results in tabs
     tabs = st.tabs(["Total Tokens", "Lemmas", "Content Words", "Lemma Content", "Multiword Units"])
     
-    metric_keys = ['total_overlap', 'lemma_overlap', 'content_overlap', 'lemma_content_overlap', 'multiword_overlap']
-    
-    for tab, key in zip(tabs, metric_keys):
+    for tab, key in zip(tabs, METRIC_KEYS):
         with tab:
             result = results[key]
             
@@ -382,37 +442,29 @@ if 'results' in st.session_state:
                 with col1:
                     st.markdown("**✅ Overlapping**")
                     if result['overlapping']:
-                        st.markdown(", ".join(result['overlapping']))
+                        st.markdown(result['overlapping_str'])
                     else:
                         st.markdown("*None*")
                 
                 with col2:
                     st.markdown("**📄 Reference Only**")
                     if result['ref_only']:
-                        st.markdown(", ".join(result['ref_only']))
+                        st.markdown(result['ref_only_str'])
                     else:
                         st.markdown("*None*")
                 
                 with col3:
                     st.markdown("**📝 Target Only**")
                     if result['target_only']:
-                        st.markdown(", ".join(result['target_only']))
+                        st.markdown(result['target_only_str'])
                     else:
                         st.markdown("*None*")
     
     # CSV Export
     st.divider()
-    csv_data = create_csv_data(
-        st.session_state.reference, 
-        st.session_state.target, 
-        results,
-        st.session_state.get('language', 'English')
-    )
-    
-    csv = csv_data.to_csv(index=False)
     st.download_button(
         label="📥 Download Results as CSV",
-        data=csv,
+        data=st.session_state.csv_bytes,
         file_name=f"text_overlap_analysis_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv",
         mime="text/csv",
         type="primary"
@@ -420,4 +472,4 @@ if 'results' in st.session_state:
     
     # Show preview of CSV
     with st.expander("Preview CSV Data"):
-        st.dataframe(csv_data, width='stretch')
+        st.dataframe(st.session_state.csv_data, width='stretch')